@@ -2,7 +2,8 @@ import os
 
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from cointrax.models import PaymentAddress
+from django.db import transaction
+from cointrax.models import PaymentAddress, EventSummary
 
 
 class Command(BaseCommand):
@@ -37,11 +38,13 @@ class Command(BaseCommand):
 
             # Create new PaymentAddress records as required.
             num_added = 0
-            for address in f_addresses:
-                if address not in p_addresses:
-                    num_added += 1
-                    payment_address = PaymentAddress()
-                    payment_address.btc_address = address
-                    payment_address.available = True
-                    payment_address.save()
+            with transaction.atomic():
+                for address in f_addresses:
+                    if address not in p_addresses:
+                        num_added += 1
+                        payment_address = PaymentAddress()
+                        payment_address.btc_address = address
+                        payment_address.available = True
+                        payment_address.save()
+                EventSummary.adjust(available_addresses=num_added)
             self.stdout.write('%d addresses added' % num_added)
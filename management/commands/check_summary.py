@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from cointrax.models import EventSummary
+
+
+class Command(BaseCommand):
+    help = 'Compares the event summary counters with totals recomputed from the database'
+    option_list = BaseCommand.option_list + (
+        make_option('--fix',
+                    action='store_true',
+                    dest='fix',
+                    default=False,
+                    help='Overwrite the summary counters with the recomputed totals'),
+    )
+
+    def handle(self, *args, **options):
+        summary = EventSummary.get_summary()
+        totals = EventSummary.compute()
+
+        # Report any counters that do not match the recomputed totals.
+        num_mismatched = 0
+        for field in EventSummary.COUNTER_FIELDS:
+            stored = getattr(summary, field)
+            if stored != totals[field]:
+                num_mismatched += 1
+                self.stdout.write('%s: stored %s, recomputed %s' %
+                                  (field, stored, totals[field]))
+
+        if not num_mismatched:
+            self.stdout.write('Event summary is consistent')
+        elif options['fix']:
+            EventSummary.rebuild()
+            self.stdout.write('Event summary rebuilt')
+        else:
+            self.stdout.write('%d counters do not match; run with --fix to '
+                              'rebuild the summary' % num_mismatched)
@@ -0,0 +1,93 @@
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import transaction
+from django.contrib.auth.models import User, AnonymousUser
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from cointrax import traffic
+
+
+class Command(BaseCommand):
+    args = '<traffic_file>'
+    help = 'Replays the view requests in a recorded traffic file without using the network'
+    option_list = BaseCommand.option_list + (
+        make_option('--username',
+                    dest='username',
+                    default=None,
+                    help='User to make the requests as (needed for the reports)'),
+        make_option('--profile-dir',
+                    dest='profile_dir',
+                    default=None,
+                    help='Directory to write cProfile statistics to'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            self.stdout.write('Usage: replay_traffic %s' % self.args)
+            return
+        traffic_fpath = os.path.abspath(args[0])
+        if not os.path.exists(traffic_fpath):
+            self.stdout.write('File not found: %s' % traffic_fpath)
+            return
+
+        if options['username']:
+            try:
+                user = User.objects.get(username=options['username'])
+            except User.DoesNotExist:
+                self.stdout.write('User not found: %s' % options['username'])
+                return
+        else:
+            user = AnonymousUser()
+
+        # Read the view requests from the traffic file.
+        request_entries = []
+        for entry in traffic.read_entries(traffic_fpath):
+            if entry['type'] == 'request':
+                request_entries.append(entry)
+        self.stdout.write('%d requests read from file' % len(request_entries))
+
+        # Replay each request with upstream responses served from the file
+        # and email kept in memory.
+        traffic.reset()
+        factory = RequestFactory()
+        with override_settings(
+                COINTRAX_TRAFFIC_MODE='replay',
+                COINTRAX_TRAFFIC_FILE=traffic_fpath,
+                COINTRAX_PROFILE_DIR=(
+                    options['profile_dir'] or
+                    getattr(settings, 'COINTRAX_PROFILE_DIR', None)),
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend'):
+            for entry in request_entries:
+                try:
+                    match = resolve(entry['path'])
+                except Resolver404:
+                    self.stdout.write('%s: no matching view' % entry['path'])
+                    continue
+                path = entry['path']
+                if entry['query']:
+                    path = '%s?%s' % (path, entry['query'])
+                request = factory.get(path)
+                request.user = user
+
+                # Roll back any changes the view makes, such as reconciled
+                # payments, so every replay starts from the same data.
+                start = time.time()
+                try:
+                    with transaction.atomic():
+                        response = match.func(request, *match.args,
+                                              **match.kwargs)
+                        transaction.set_rollback(True)
+                except Exception as e:
+                    self.stdout.write('%s: error %s' % (path, e))
+                    continue
+                self.stdout.write(
+                    '%s: status %d, %.3f s (recorded %.3f s)' %
+                    (path, response.status_code, time.time() - start,
+                     entry['elapsed'])
+                )
+        traffic.reset()
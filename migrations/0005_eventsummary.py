@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import F, Sum
+
+
+def populate_summary(apps, schema_editor):
+    EventSummary = apps.get_model('cointrax', 'EventSummary')
+    PaymentAddress = apps.get_model('cointrax', 'PaymentAddress')
+    Registration = apps.get_model('cointrax', 'Registration')
+    totals = Registration.objects.aggregate(
+        payment_usd=Sum('payment_usd'),
+        payment_btc=Sum('payment_btc')
+    )
+    EventSummary.objects.create(
+        pk=1,
+        registration_count=Registration.objects.count(),
+        payment_usd=totals['payment_usd'] or 0,
+        payment_btc=totals['payment_btc'] or 0,
+        received_btc=0,
+        paid_count=Registration.objects.filter(
+            received_btc__gte=F('payment_btc')).count(),
+        available_addresses=PaymentAddress.objects.filter(
+            available=True).count()
+    )
+
+
+def remove_summary(apps, schema_editor):
+    EventSummary = apps.get_model('cointrax', 'EventSummary')
+    EventSummary.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cointrax', '0004_auto_20150324_0741'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registration',
+            name='received_btc',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.CreateModel(
+            name='EventSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('registration_count', models.IntegerField(default=0)),
+                ('payment_usd', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('payment_btc', models.BigIntegerField(default=0)),
+                ('received_btc', models.BigIntegerField(default=0)),
+                ('paid_count', models.IntegerField(default=0)),
+                ('available_addresses', models.IntegerField(default=0)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(populate_summary, remove_summary),
+    ]
@@ -1,8 +1,14 @@
-from django.db import models
+import logging
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
 from django import forms
 
 from captcha.fields import CaptchaField
 
+logger = logging.getLogger(__name__)
+
 
 class PaymentAddress(models.Model):
     btc_address = models.CharField(max_length=35)
@@ -16,9 +22,123 @@ class Registration(models.Model):
     payment_usd = models.DecimalField(max_digits=5, decimal_places=2)
     payment_btc = models.IntegerField()
     btc_address = models.CharField(max_length=35)
+    received_btc = models.IntegerField(default=0)
     date_added = models.DateTimeField(auto_now_add=True)
     date_updated = models.DateTimeField(auto_now=True)
 
+    def is_paid(self):
+        return self.received_btc >= self.payment_btc
+
+    def set_received_btc(self, received_btc):
+        """
+        Stores the amount received (in Satoshis) and updates the event summary
+        in the same transaction. Returns True if the amount changed.
+        """
+        with transaction.atomic():
+            # Re-read the row under a lock so concurrent reconciliations of
+            # the same registration are applied to the summary only once.
+            current = Registration.objects.select_for_update().get(pk=self.pk)
+            self.received_btc = current.received_btc
+            if received_btc == current.received_btc:
+                return False
+            was_paid = current.is_paid()
+            delta = received_btc - current.received_btc
+            self.received_btc = received_btc
+            self.save(update_fields=['received_btc', 'date_updated'])
+            EventSummary.adjust(
+                received_btc=delta,
+                paid_count=int(self.is_paid()) - int(was_paid)
+            )
+        return True
+
+
+class EventSummary(models.Model):
+    """
+    Running totals for the event, kept in a single row so the dashboard
+    does not have to read the Registration or PaymentAddress tables.
+    BTC amounts are stored in Satoshis.
+    """
+    SUMMARY_ID = 1
+
+    registration_count = models.IntegerField(default=0)
+    payment_usd = models.DecimalField(max_digits=12, decimal_places=2,
+                                      default=0)
+    payment_btc = models.BigIntegerField(default=0)
+    received_btc = models.BigIntegerField(default=0)
+    paid_count = models.IntegerField(default=0)
+    available_addresses = models.IntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    COUNTER_FIELDS = ('registration_count', 'payment_usd', 'payment_btc',
+                      'received_btc', 'paid_count', 'available_addresses')
+
+    @classmethod
+    def get_summary(cls):
+        try:
+            return cls.objects.get(pk=cls.SUMMARY_ID)
+        except cls.DoesNotExist:
+            # Recompute the totals rather than starting from zero.
+            logger.error('EventSummary row missing; rebuilding it')
+            return cls.rebuild()
+
+    @classmethod
+    def adjust(cls, **deltas):
+        """
+        Atomically adds the given deltas to the summary counters. Call this
+        inside the transaction that changes the underlying rows.
+        """
+        updates = {'date_updated': timezone.now()}
+        for field, delta in deltas.items():
+            if delta:
+                updates[field] = F(field) + delta
+        if not cls.objects.filter(pk=cls.SUMMARY_ID).update(**updates):
+            # The row is missing, so adding deltas to a new zero row would
+            # give wrong totals. Recompute them instead.
+            logger.error('EventSummary row missing; rebuilding it')
+            cls.rebuild()
+
+    @classmethod
+    def compute(cls):
+        """
+        Returns a dictionary of the totals recomputed with database
+        aggregates.
+        """
+        totals = Registration.objects.aggregate(
+            payment_usd=Sum('payment_usd'),
+            payment_btc=Sum('payment_btc'),
+            received_btc=Sum('received_btc')
+        )
+        return {
+            'registration_count': Registration.objects.count(),
+            'payment_usd': totals['payment_usd'] or 0,
+            'payment_btc': totals['payment_btc'] or 0,
+            'received_btc': totals['received_btc'] or 0,
+            'paid_count': Registration.objects.filter(
+                received_btc__gte=F('payment_btc')).count(),
+            'available_addresses': PaymentAddress.objects.filter(
+                available=True).count(),
+        }
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Overwrites the summary counters with recomputed totals.
+        """
+        try:
+            with transaction.atomic():
+                # Lock the row so concurrent adjustments wait for the rebuild.
+                summary = cls.objects.select_for_update().filter(
+                    pk=cls.SUMMARY_ID).first()
+                if summary is None:
+                    summary = cls(pk=cls.SUMMARY_ID)
+                for field, value in cls.compute().items():
+                    setattr(summary, field, value)
+                summary.save()
+        except IntegrityError:
+            # Another request created the row first, so rebuild that one.
+            return cls.rebuild()
+        return summary
+
 
 class RegistrationForm(forms.Form):
     full_name = forms.CharField(
@@ -1,3 +1,549 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+from decimal import Decimal
 
-# Create your tests here.
+import requests
+
+from django.contrib.auth.models import User, Group
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+from captcha.models import CaptchaStore
+
+from cointrax import traffic
+from cointrax.models import PaymentAddress, Registration, EventSummary
+
+
+def create_registration(btc_address, payment_btc, payment_usd='10.00'):
+    """
+    Creates a registration and updates the summary the way the index view
+    does.
+    """
+    registration = Registration.objects.create(
+        full_name='Test Registrant',
+        email_address='test@example.com',
+        btc_price=Decimal('250.00'),
+        payment_usd=Decimal(payment_usd),
+        payment_btc=payment_btc,
+        btc_address=btc_address
+    )
+    EventSummary.adjust(
+        registration_count=1,
+        payment_usd=registration.payment_usd,
+        payment_btc=registration.payment_btc,
+        paid_count=int(registration.is_paid())
+    )
+    return registration
+
+
+class SetReceivedBtcTest(TestCase):
+    def setUp(self):
+        EventSummary.rebuild()
+        self.registration = create_registration('1TestAddress', 5000)
+
+    def test_partial_payment(self):
+        self.assertTrue(self.registration.set_received_btc(2000))
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.received_btc, 2000)
+        self.assertEqual(summary.paid_count, 0)
+        self.assertEqual(
+            Registration.objects.get(pk=self.registration.pk).received_btc,
+            2000
+        )
+
+    def test_paid_transition(self):
+        self.registration.set_received_btc(2000)
+        self.registration.set_received_btc(6000)
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.received_btc, 6000)
+        self.assertEqual(summary.paid_count, 1)
+
+    def test_unpaid_transition(self):
+        self.registration.set_received_btc(5000)
+        self.registration.set_received_btc(1000)
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.received_btc, 1000)
+        self.assertEqual(summary.paid_count, 0)
+
+    def test_unchanged_amount(self):
+        self.registration.set_received_btc(5000)
+        self.assertFalse(self.registration.set_received_btc(5000))
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.received_btc, 5000)
+        self.assertEqual(summary.paid_count, 1)
+
+    def test_stale_instance(self):
+        # A second copy loaded before the first update must not count the
+        # payment again.
+        stale = Registration.objects.get(pk=self.registration.pk)
+        self.registration.set_received_btc(5000)
+        self.assertFalse(stale.set_received_btc(5000))
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.received_btc, 5000)
+        self.assertEqual(summary.paid_count, 1)
+
+
+class EventSummaryTest(TestCase):
+    def setUp(self):
+        for btc_address in ('1AddressA', '1AddressB', '1AddressC'):
+            PaymentAddress.objects.create(btc_address=btc_address)
+        EventSummary.rebuild()
+
+    def test_adjust_matches_compute(self):
+        PaymentAddress.objects.filter(btc_address='1AddressA').update(
+            available=False)
+        EventSummary.adjust(available_addresses=-1)
+        create_registration('1AddressA', 4000, '10.00')
+        registration = create_registration('1AddressB', 8000, '20.00')
+        registration.set_received_btc(8000)
+
+        summary = EventSummary.get_summary()
+        totals = EventSummary.compute()
+        for field in EventSummary.COUNTER_FIELDS:
+            self.assertEqual(getattr(summary, field), totals[field])
+        self.assertEqual(summary.registration_count, 2)
+        self.assertEqual(summary.payment_usd, Decimal('30.00'))
+        self.assertEqual(summary.payment_btc, 12000)
+        self.assertEqual(summary.paid_count, 1)
+        self.assertEqual(summary.available_addresses, 2)
+
+    def test_rebuild(self):
+        create_registration('1AddressA', 4000)
+        EventSummary.objects.update(registration_count=10, payment_btc=0)
+        summary = EventSummary.rebuild()
+        self.assertEqual(summary.registration_count, 1)
+        self.assertEqual(summary.payment_btc, 4000)
+        self.assertEqual(summary.available_addresses, 3)
+
+    def test_get_summary_missing_row(self):
+        create_registration('1AddressA', 4000)
+        EventSummary.objects.all().delete()
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.registration_count, 1)
+        self.assertEqual(summary.payment_btc, 4000)
+        self.assertEqual(summary.available_addresses, 3)
+
+    def test_adjust_missing_row(self):
+        create_registration('1AddressA', 4000)
+        EventSummary.objects.all().delete()
+        EventSummary.adjust(registration_count=1)
+        summary = EventSummary.get_summary()
+        self.assertEqual(summary.registration_count, 1)
+        self.assertEqual(summary.payment_btc, 4000)
+
+
+class CheckSummaryTest(TestCase):
+    def setUp(self):
+        PaymentAddress.objects.create(btc_address='1AddressA')
+        EventSummary.rebuild()
+
+    def test_consistent(self):
+        out = StringIO()
+        call_command('check_summary', stdout=out)
+        self.assertIn('Event summary is consistent', out.getvalue())
+
+    def test_mismatch(self):
+        EventSummary.objects.update(available_addresses=5)
+        out = StringIO()
+        call_command('check_summary', stdout=out)
+        self.assertIn('available_addresses: stored 5, recomputed 1',
+                      out.getvalue())
+        self.assertIn('run with --fix', out.getvalue())
+        self.assertEqual(EventSummary.get_summary().available_addresses, 5)
+
+    def test_fix(self):
+        EventSummary.objects.update(available_addresses=5)
+        out = StringIO()
+        call_command('check_summary', fix=True, stdout=out)
+        self.assertIn('Event summary rebuilt', out.getvalue())
+        self.assertEqual(EventSummary.get_summary().available_addresses, 1)
+
+
+def write_traffic_file(entries):
+    """
+    Writes traffic entries to a temporary file and returns its path.
+    """
+    traffic_fd, traffic_fpath = tempfile.mkstemp(suffix='.jsonl')
+    traffic_file = os.fdopen(traffic_fd, 'w')
+    for entry in entries:
+        traffic_file.write(json.dumps(entry) + '\n')
+    traffic_file.close()
+    return traffic_fpath
+
+
+def upstream_entry(url, data):
+    return {'type': 'upstream', 'url': url, 'status_code': 200,
+            'text': json.dumps(data), 'elapsed': 0.1}
+
+
+@override_settings(EVENT_NAME='Test Event', ENVIRONMENT_NAME='',
+                   HOSTURL='http://testserver')
+class ViewTestCase(TestCase):
+    """
+    Base class for view tests. Upstream requests are replayed from the
+    entries in traffic_entries.
+    """
+    traffic_entries = []
+
+    def setUp(self):
+        Group.objects.create(name='managers')
+        for btc_address in ('1AddressA', '1AddressB', '1AddressC'):
+            PaymentAddress.objects.create(btc_address=btc_address)
+        EventSummary.rebuild()
+
+        self.traffic_fpath = write_traffic_file(self.traffic_entries)
+        self.traffic_settings = override_settings(
+            COINTRAX_TRAFFIC_MODE='replay',
+            COINTRAX_TRAFFIC_FILE=self.traffic_fpath
+        )
+        self.traffic_settings.enable()
+        traffic.reset()
+
+    def tearDown(self):
+        self.traffic_settings.disable()
+        traffic.reset()
+        os.remove(self.traffic_fpath)
+
+    def add_registration(self, btc_address, payment_btc):
+        PaymentAddress.objects.filter(btc_address=btc_address).update(
+            available=False)
+        registration = Registration.objects.create(
+            full_name='Test Registrant',
+            email_address='test@example.com',
+            btc_price=Decimal('250.00'),
+            payment_usd=Decimal('10.00'),
+            payment_btc=payment_btc,
+            btc_address=btc_address
+        )
+        EventSummary.rebuild()
+        return registration
+
+    def login_manager(self):
+        user = User.objects.create_user('manager', 'manager@example.com',
+                                        'password')
+        user.groups.add(Group.objects.get(name='managers'))
+        self.client.login(username='manager', password='password')
+
+    def assertSummaryConsistent(self):
+        summary = EventSummary.get_summary()
+        totals = EventSummary.compute()
+        for field in EventSummary.COUNTER_FIELDS:
+            self.assertEqual(getattr(summary, field), totals[field])
+        return summary
+
+
+class IndexViewTest(ViewTestCase):
+    def post_registration(self):
+        hashkey = CaptchaStore.generate_key()
+        return self.client.post(reverse('index'), {
+            'full_name': 'Test Registrant',
+            'email_address': 'test@example.com',
+            'captcha_0': hashkey,
+            'captcha_1': CaptchaStore.objects.get(hashkey=hashkey).response,
+            'btc_price': '250.00',
+            'payment_usd': '10.00',
+        })
+
+    def test_register(self):
+        response = self.post_registration()
+        self.assertRedirects(response, reverse('address', args=['1AddressA']))
+        registration = Registration.objects.get()
+        self.assertEqual(registration.btc_address, '1AddressA')
+        self.assertEqual(registration.payment_btc, 4000000)
+        self.assertFalse(
+            PaymentAddress.objects.get(btc_address='1AddressA').available)
+
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.registration_count, 1)
+        self.assertEqual(summary.payment_btc, 4000000)
+        self.assertEqual(summary.available_addresses, 2)
+
+    def test_next_address(self):
+        self.post_registration()
+        self.post_registration()
+        self.assertEqual(
+            sorted(Registration.objects.values_list('btc_address', flat=True)),
+            ['1AddressA', '1AddressB']
+        )
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.available_addresses, 1)
+
+    def test_no_address_left(self):
+        PaymentAddress.objects.update(available=False)
+        EventSummary.rebuild()
+        response = self.post_registration()
+        self.assertRedirects(response, reverse('not_available'))
+        self.assertFalse(Registration.objects.exists())
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.registration_count, 0)
+
+
+class EventSummaryViewTest(ViewTestCase):
+    def test_html(self):
+        self.add_registration('1AddressA', 5000)
+        self.login_manager()
+        response = self.client.get(reverse('event_summary'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Event Summary')
+        self.assertContains(response, '0.05000')
+
+    def test_json(self):
+        self.add_registration('1AddressA', 5000)
+        self.login_manager()
+        response = self.client.get(reverse('event_summary'),
+                                   {'format': 'json'})
+        self.assertEqual(response['Content-Type'], 'application/json')
+        results = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(results['registration_count'], 1)
+        self.assertEqual(results['payment_usd'], '10.00')
+        self.assertEqual(results['payment_mbtc'], '0.05000')
+        self.assertEqual(results['received_mbtc'], '0.00000')
+        self.assertEqual(results['paid_count'], 0)
+        self.assertEqual(results['available_addresses'], 2)
+
+    def test_anonymous(self):
+        response = self.client.get(reverse('event_summary'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_not_manager(self):
+        User.objects.create_user('visitor', 'visitor@example.com',
+                                 'password')
+        self.client.login(username='visitor', password='password')
+        response = self.client.get(reverse('event_summary'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/forbidden/', response['Location'])
+
+
+class BtcTransViewTest(ViewTestCase):
+    traffic_entries = [
+        upstream_entry('https://blockchain.info/latestblock',
+                       {'height': 100}),
+        upstream_entry(
+            'https://blockchain.info/address/1AddressA?format=json',
+            {'total_received': 5000,
+             'txs': [{'block_height': 100,
+                      'out': [{'addr': '1AddressA', 'value': 5000}]}]}
+        ),
+    ]
+
+    def test_reconcile(self):
+        registration = self.add_registration('1AddressA', 5000)
+        response = self.client.get(reverse('btctrans', args=['1AddressA']))
+        results = json.loads(response.content.decode('utf-8'))
+        self.assertTrue(results['successful'])
+        self.assertEqual(
+            Registration.objects.get(pk=registration.pk).received_btc, 5000)
+
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.received_btc, 5000)
+        self.assertEqual(summary.paid_count, 1)
+
+        # Polling again does not count the payment twice.
+        self.client.get(reverse('btctrans', args=['1AddressA']))
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.received_btc, 5000)
+
+
+class RegistrationReportViewTest(ViewTestCase):
+    traffic_entries = [
+        upstream_entry(
+            'https://blockchain.info/multiaddr?active=1AddressA|1AddressB',
+            {'addresses': [{'address': '1AddressA', 'total_received': 5000},
+                           {'address': '1AddressB', 'total_received': 100}]}
+        ),
+    ]
+
+    def test_reconcile(self):
+        self.add_registration('1AddressA', 5000)
+        self.add_registration('1AddressB', 5000)
+        self.login_manager()
+        response = self.client.get(reverse('registration_report'))
+        self.assertEqual(response.status_code, 200)
+
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.received_btc, 5100)
+        self.assertEqual(summary.paid_count, 1)
+
+
+@traffic.traffic_view
+def example_view(request):
+    return HttpResponse('ok')
+
+
+class TrafficTest(TestCase):
+    def setUp(self):
+        traffic_fd, self.traffic_fpath = tempfile.mkstemp(suffix='.jsonl')
+        os.close(traffic_fd)
+        self.requests_get = requests.get
+        traffic.reset()
+
+    def tearDown(self):
+        requests.get = self.requests_get
+        traffic.reset()
+        os.remove(self.traffic_fpath)
+
+    def write_entries(self, entries):
+        traffic_file = open(self.traffic_fpath, 'w')
+        for entry in entries:
+            traffic_file.write(json.dumps(entry) + '\n')
+        traffic_file.close()
+
+    def test_record(self):
+        def fake_get(url, **kwargs):
+            return traffic.ReplayResponse(200, '{"USD": {"last": 250.0}}')
+        requests.get = fake_get
+
+        with override_settings(COINTRAX_TRAFFIC_MODE='record',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            r = traffic.get('https://blockchain.info/ticker', timeout=10.0)
+            example_view(RequestFactory().get('/cointrax/btcprice/',
+                                              {'a': '1'}))
+        self.assertEqual(r.json()['USD']['last'], 250.0)
+
+        entries = traffic.read_entries(self.traffic_fpath)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['type'], 'upstream')
+        self.assertEqual(entries[0]['url'], 'https://blockchain.info/ticker')
+        self.assertEqual(entries[0]['status_code'], 200)
+        self.assertEqual(entries[0]['text'], '{"USD": {"last": 250.0}}')
+        self.assertEqual(entries[1]['type'], 'request')
+        self.assertEqual(entries[1]['view'], 'example_view')
+        self.assertEqual(entries[1]['path'], '/cointrax/btcprice/')
+        self.assertEqual(entries[1]['query'], 'a=1')
+        self.assertEqual(entries[1]['status_code'], 200)
+
+    def test_record_post(self):
+        with override_settings(COINTRAX_TRAFFIC_MODE='record',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            example_view(RequestFactory().post('/cointrax/',
+                                               {'full_name': 'Test'}))
+        self.assertEqual(traffic.read_entries(self.traffic_fpath), [])
+
+    def test_replay_order(self):
+        url = 'https://blockchain.info/latestblock'
+        self.write_entries([
+            {'type': 'upstream', 'url': url, 'status_code': 200,
+             'text': '{"height": 1}', 'elapsed': 0.1},
+            {'type': 'upstream', 'url': url, 'status_code': 200,
+             'text': '{"height": 2}', 'elapsed': 0.1},
+        ])
+        with override_settings(COINTRAX_TRAFFIC_MODE='replay',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            heights = [traffic.get(url).json()['height'] for i in range(3)]
+        self.assertEqual(heights, [1, 2, 1])
+
+    def test_replay_errors(self):
+        self.write_entries([
+            {'type': 'upstream', 'url': 'https://blockchain.info/ticker',
+             'error': 'timeout', 'message': 'timed out', 'elapsed': 10.0},
+            {'type': 'upstream', 'url': 'https://blockchain.info/latestblock',
+             'error': 'request', 'message': 'refused', 'elapsed': 0.1},
+        ])
+        with override_settings(COINTRAX_TRAFFIC_MODE='replay',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            self.assertRaises(requests.exceptions.Timeout, traffic.get,
+                              'https://blockchain.info/ticker')
+            self.assertRaises(requests.exceptions.RequestException,
+                              traffic.get,
+                              'https://blockchain.info/latestblock')
+
+    def test_replay_malformed(self):
+        self.write_entries([
+            {'type': 'upstream', 'url': 'https://blockchain.info/ticker',
+             'elapsed': 0.1},
+        ])
+        with override_settings(COINTRAX_TRAFFIC_MODE='replay',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            self.assertRaises(requests.exceptions.RequestException,
+                              traffic.get, 'https://blockchain.info/ticker')
+
+    def test_record_without_file(self):
+        with override_settings(COINTRAX_TRAFFIC_MODE='record',
+                               COINTRAX_TRAFFIC_FILE=None):
+            response = example_view(
+                RequestFactory().get('/cointrax/btcprice/'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_replay_unrecorded(self):
+        self.write_entries([])
+        with override_settings(COINTRAX_TRAFFIC_MODE='replay',
+                               COINTRAX_TRAFFIC_FILE=self.traffic_fpath):
+            self.assertRaises(requests.exceptions.RequestException,
+                              traffic.get, 'https://blockchain.info/ticker')
+
+
+class ReplayTrafficTest(ViewTestCase):
+    def setUp(self):
+        super(ReplayTrafficTest, self).setUp()
+        self.registration = self.add_registration('1AddressA', 5000)
+        self.replay_fpath = write_traffic_file(
+            BtcTransViewTest.traffic_entries + [
+                {'type': 'upstream',
+                 'url': 'https://blockchain.info/address/1AddressB?format=json',
+                 'status_code': 200, 'text': 'not json', 'elapsed': 0.1},
+                {'type': 'request', 'view': 'btctrans',
+                 'path': reverse('btctrans', args=['1AddressB']),
+                 'query': '', 'status_code': 200, 'elapsed': 0.2},
+                {'type': 'request', 'view': 'btctrans',
+                 'path': reverse('btctrans', args=['1AddressA']),
+                 'query': '', 'status_code': 200, 'elapsed': 0.2},
+            ]
+        )
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.remove(self.replay_fpath)
+        shutil.rmtree(self.profile_dir)
+        super(ReplayTrafficTest, self).tearDown()
+
+    def test_replay(self):
+        out = StringIO()
+        call_command('replay_traffic', self.replay_fpath, stdout=out)
+        self.assertIn('2 requests read from file', out.getvalue())
+        self.assertIn('%s: status 200' %
+                      reverse('btctrans', args=['1AddressA']),
+                      out.getvalue())
+
+        # The reconciled payment is rolled back.
+        self.assertEqual(
+            Registration.objects.get(pk=self.registration.pk).received_btc, 0)
+        summary = self.assertSummaryConsistent()
+        self.assertEqual(summary.received_btc, 0)
+        self.assertEqual(summary.paid_count, 0)
+
+    def test_failing_request(self):
+        # The response for 1AddressB is not JSON, so the view raises;
+        # replay continues with the next request.
+        out = StringIO()
+        call_command('replay_traffic', self.replay_fpath, stdout=out)
+        self.assertIn('%s: error' % reverse('btctrans', args=['1AddressB']),
+                      out.getvalue())
+        self.assertIn('%s: status 200' %
+                      reverse('btctrans', args=['1AddressA']),
+                      out.getvalue())
+
+    def test_profile_dir(self):
+        call_command('replay_traffic', self.replay_fpath,
+                     profile_dir=self.profile_dir, stdout=StringIO())
+        stats_fnames = [fname for fname in os.listdir(self.profile_dir)
+                        if fname.startswith('btctrans-') and
+                        fname.endswith('.prof')]
+        self.assertTrue(stats_fnames)
+
+    def test_missing_file(self):
+        out = StringIO()
+        call_command('replay_traffic', '/nonexistent/traffic.jsonl',
+                     stdout=out)
+        self.assertIn('File not found', out.getvalue())
+
+    def test_unknown_user(self):
+        out = StringIO()
+        call_command('replay_traffic', self.replay_fpath, username='nobody',
+                     stdout=out)
+        self.assertIn('User not found: nobody', out.getvalue())
@@ -0,0 +1,205 @@
+"""
+Record and replay of upstream HTTP traffic, and per-view profiling.
+
+The mode is selected with the COINTRAX_TRAFFIC_MODE setting:
+
+    'record' - Upstream responses and view request timings are appended to
+               COINTRAX_TRAFFIC_FILE as one JSON object per line.
+    'replay' - Upstream responses are served from COINTRAX_TRAFFIC_FILE and
+               the network is never used.
+
+If COINTRAX_PROFILE_DIR is set, each decorated view is run under cProfile
+and the statistics are written to that directory.
+"""
+import cProfile
+import functools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_replay_responses = {}
+_replay_positions = {}
+
+
+class ReplayResponse(object):
+    """
+    Stands in for a requests.Response built from a recorded entry.
+    """
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def get_mode():
+    return getattr(settings, 'COINTRAX_TRAFFIC_MODE', None)
+
+
+def write_entry(entry):
+    """
+    Appends an entry to the traffic file.
+    """
+    traffic_fpath = getattr(settings, 'COINTRAX_TRAFFIC_FILE', None)
+    if not traffic_fpath:
+        logger.error('COINTRAX_TRAFFIC_FILE is not set')
+        return
+    line = json.dumps(entry, sort_keys=True)
+    with _lock:
+        try:
+            traffic_file = open(traffic_fpath, 'a')
+            traffic_file.write(line + '\n')
+            traffic_file.close()
+        except (IOError, OSError) as e:
+            logger.error('Unable to write to traffic file: %s' % e)
+
+
+def read_entries(traffic_fpath):
+    """
+    Returns a list of the entries in a traffic file.
+    """
+    entries = []
+    traffic_file = open(traffic_fpath)
+    for line in traffic_file:
+        line = line.strip()
+        if line:
+            entries.append(json.loads(line))
+    traffic_file.close()
+    return entries
+
+
+def reset():
+    """
+    Discards loaded responses so the next replay starts from the beginning
+    of the traffic file.
+    """
+    with _lock:
+        _replay_responses.clear()
+        _replay_positions.clear()
+
+
+def _load_responses():
+    if _replay_responses:
+        return
+    traffic_fpath = getattr(settings, 'COINTRAX_TRAFFIC_FILE', None)
+    if not traffic_fpath:
+        raise requests.exceptions.RequestException(
+            'COINTRAX_TRAFFIC_FILE is not set'
+        )
+    try:
+        entries = read_entries(traffic_fpath)
+    except (IOError, OSError) as e:
+        raise requests.exceptions.RequestException(
+            'Unable to read traffic file: %s' % e
+        )
+    for entry in entries:
+        if entry['type'] == 'upstream':
+            _replay_responses.setdefault(entry['url'], []).append(entry)
+
+
+def _replay(url):
+    # Responses for the same URL are returned in the order recorded,
+    # starting over after the last one.
+    with _lock:
+        _load_responses()
+        if url not in _replay_responses:
+            raise requests.exceptions.RequestException(
+                'No recorded response for %s' % url
+            )
+        position = _replay_positions.get(url, 0)
+        entries = _replay_responses[url]
+        entry = entries[position % len(entries)]
+        _replay_positions[url] = position + 1
+
+    if entry.get('error') == 'timeout':
+        raise requests.exceptions.Timeout(entry['message'])
+    elif entry.get('error'):
+        raise requests.exceptions.RequestException(entry['message'])
+    elif 'status_code' not in entry or 'text' not in entry:
+        raise requests.exceptions.RequestException(
+            'Malformed recorded response for %s' % url
+        )
+    return ReplayResponse(entry['status_code'], entry['text'])
+
+
+def get(url, **kwargs):
+    """
+    Performs requests.get(), or serves a recorded response, depending on
+    the traffic mode.
+    """
+    mode = get_mode()
+    if mode == 'replay':
+        return _replay(url)
+    elif mode != 'record':
+        return requests.get(url, **kwargs)
+
+    # Only responses and requests exceptions are recorded, since those are
+    # the only outcomes that can be replayed.
+    entry = {'type': 'upstream', 'url': url}
+    start = time.time()
+    try:
+        r = requests.get(url, **kwargs)
+    except requests.exceptions.Timeout as e:
+        entry['error'] = 'timeout'
+        entry['message'] = str(e)
+        entry['elapsed'] = time.time() - start
+        write_entry(entry)
+        raise
+    except requests.exceptions.RequestException as e:
+        entry['error'] = 'request'
+        entry['message'] = str(e)
+        entry['elapsed'] = time.time() - start
+        write_entry(entry)
+        raise
+    entry['status_code'] = r.status_code
+    entry['text'] = r.text
+    entry['elapsed'] = time.time() - start
+    write_entry(entry)
+    return r
+
+
+def traffic_view(view):
+    """
+    Decorator which records request timings and profiles the view,
+    depending on the settings.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        profile_dir = getattr(settings, 'COINTRAX_PROFILE_DIR', None)
+        start = time.time()
+        if profile_dir:
+            profiler = cProfile.Profile()
+            response = profiler.runcall(view, request, *args, **kwargs)
+            try:
+                stats_fd, stats_fpath = tempfile.mkstemp(
+                    dir=profile_dir, prefix='%s-' % view.__name__,
+                    suffix='.prof'
+                )
+                os.close(stats_fd)
+                profiler.dump_stats(stats_fpath)
+            except (IOError, OSError) as e:
+                logger.error('Unable to write profile statistics: %s' % e)
+        else:
+            response = view(request, *args, **kwargs)
+
+        # Only GET requests are recorded, so no form data is stored.
+        if get_mode() == 'record' and request.method == 'GET':
+            write_entry({'type': 'request',
+                         'view': view.__name__,
+                         'path': request.path,
+                         'query': request.GET.urlencode(),
+                         'status_code': response.status_code,
+                         'elapsed': time.time() - start})
+        return response
+    return wrapper
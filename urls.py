@@ -15,4 +15,5 @@ urlpatterns = patterns('',
     url(r'^qrcode/', views.qrcode, name='qrcode'),
     url(r'^address-report/', views.address_report, name='address_report'),
     url(r'^registration-report/', views.registration_report, name='registration_report'),
+    url(r'^event-summary/', views.event_summary, name='event_summary'),
 )
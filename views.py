@@ -13,12 +13,15 @@ from django.utils import timezone
 from django.core.mail import send_mail
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.template import Context, Template
 from django.template.loader import get_template
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.decorators import login_required, user_passes_test
 
-from cointrax.models import PaymentAddress, Registration, RegistrationForm
+from cointrax.models import (PaymentAddress, Registration, RegistrationForm,
+                             EventSummary)
+from cointrax import traffic
 
 logger = logging.getLogger(__name__)
 
@@ -55,6 +58,39 @@ def in_managers_group(user):
     return user.groups.filter(name='managers').exists()
 
 
+def claim_payment_address():
+    """
+    Marks the next available payment address as not available and returns
+    it, or returns None if there are no addresses left. Call this inside a
+    transaction; the row lock ensures concurrent requests never claim the
+    same address.
+    """
+    payment_address = PaymentAddress.objects.select_for_update().filter(
+        available=True).order_by('pk').first()
+    if payment_address is not None:
+        payment_address.available = False
+        payment_address.save()
+    return payment_address
+
+
+def reconcile_payment(registration, received_btc):
+    """
+    Stores the amount received (in Satoshis) for a registration, which also
+    updates the event summary.
+    """
+    try:
+        received_btc = int(received_btc)
+        # Most checks find nothing new, so skip the locking transaction.
+        if registration.received_btc == received_btc:
+            return
+        if registration.set_received_btc(received_btc):
+            logger.info('Updated amount received for %s' %
+                        registration.btc_address)
+    except Exception as e:
+        logger.error('Unable to update Registration table: %s' % e)
+
+
+@traffic.traffic_view
 def index(request):
     if request.method == 'POST':
         # This is a POST request so we need to process the form data.
@@ -66,31 +102,6 @@ def index(request):
             payment_usd = form.cleaned_data['payment_usd']
             btc_price = form.cleaned_data['btc_price']
 
-            # Get the next available payment address.
-            try:
-                address_set = PaymentAddress.objects.filter(available=True)
-            except Exception as e:
-                logger.error('Unable to query PaymentAddress table: %s' % e)
-                return render(request, '500.html',
-                              {'event_name': settings.EVENT_NAME,
-                               'environment_name': settings.ENVIRONMENT_NAME})
-
-            if len(address_set) == 0:
-                return HttpResponseRedirect(reverse('not_available'))
-            payment_address = address_set[0]
-
-            # Mark this payment address as not available.
-            try:
-                payment_address.available = False
-                payment_address.save()
-                logger.info('Reserving BTC address %s' %
-                            payment_address.btc_address)
-            except Exception as e:
-                logger.error('Unable to update PaymentAddress table: %s' % e)
-                return render(request, '500.html',
-                              {'event_name': settings.EVENT_NAME,
-                               'environment_name': settings.ENVIRONMENT_NAME})
-
             # Create a Registration record.
             registration = Registration()
             registration.full_name = full_name
@@ -102,17 +113,34 @@ def index(request):
             registration.payment_btc = int(payment_usd/btc_price *
                                            100000000)
 
-            registration.btc_address = payment_address.btc_address
+            # Claim the next available payment address, save the
+            # registration and update the event summary together.
             try:
-                registration.save()
-                logger.info('Created registration record for %s' %
-                            registration.full_name)
+                with transaction.atomic():
+                    payment_address = claim_payment_address()
+                    if payment_address:
+                        registration.btc_address = payment_address.btc_address
+                        registration.save()
+                        EventSummary.adjust(
+                            registration_count=1,
+                            payment_usd=registration.payment_usd,
+                            payment_btc=registration.payment_btc,
+                            paid_count=int(registration.is_paid()),
+                            available_addresses=-1
+                        )
             except Exception as e:
                 logger.error('Unable to update Registration table: %s' % e)
                 return render(request, '500.html',
                               {'event_name': settings.EVENT_NAME,
                                'environment_name': settings.ENVIRONMENT_NAME})
 
+            if not payment_address:
+                return HttpResponseRedirect(reverse('not_available'))
+            logger.info('Reserving BTC address %s' %
+                        payment_address.btc_address)
+            logger.info('Created registration record for %s' %
+                        registration.full_name)
+
             # Calculate the payment in BTC and mBTC.
             payment_btc = (Decimal(registration.payment_btc) / 100000000).quantize(Decimal('0.00000001'))
             payment_mbtc = (Decimal(registration.payment_btc) / 100000).quantize(Decimal('0.00001'))
@@ -204,11 +232,12 @@ def index(request):
                    'environment_name': settings.ENVIRONMENT_NAME})
 
 
+@traffic.traffic_view
 def btcprice(request):
     results = {}
     results['timestamp'] = timezone.localtime(timezone.now()).strftime('%m/%d/%Y %H:%M:%S %Z')
     try:
-        r = requests.get('https://blockchain.info/ticker', timeout=10.0)
+        r = traffic.get('https://blockchain.info/ticker', timeout=10.0)
     except requests.exceptions.Timeout:
         logger.error('Timeout querying for BTC price')
         results['successful'] = False
@@ -232,6 +261,7 @@ def btcprice(request):
     return HttpResponse(json_data, content_type='application/json')
 
 
+@traffic.traffic_view
 def address(request, btc_address):
     # Make sure the registration record exists.
     try:
@@ -309,11 +339,12 @@ def qrcode(request):
     return HttpResponse(image_data, content_type="image/png")
 
 
+@traffic.traffic_view
 def btctrans(request, btc_address):
     # Get the height of the latest block.
     current_block_height = None
     try:
-        r = requests.get('https://blockchain.info/latestblock', timeout=10.0)
+        r = traffic.get('https://blockchain.info/latestblock', timeout=10.0)
     except requests.exceptions.Timeout:
         logger.error('Timeout querying for blockchain height')
     except requests.exceptions.RequestException as e:
@@ -338,9 +369,9 @@ def btctrans(request, btc_address):
     results['transactions'] = []
     results['total_received'] = 0
     try:
-        r = requests.get('https://blockchain.info/address/%s?format=json' %
-                         btc_address,
-                         timeout=10.0)
+        r = traffic.get('https://blockchain.info/address/%s?format=json' %
+                       btc_address,
+                       timeout=10.0)
     except requests.exceptions.Timeout:
         logger.error('Timeout querying for transaction info')
     except requests.exceptions.RequestException as e:
@@ -384,6 +415,18 @@ def btctrans(request, btc_address):
                             results['total_received'] += amount
                             results['transactions'].append(['%.5f' % amount,
                                                             confirmations_str])
+
+            # Reconcile the stored payment and the event summary.
+            if 'total_received' in r.json():
+                try:
+                    registration = Registration.objects.filter(
+                        btc_address=btc_address).first()
+                except Exception as e:
+                    logger.error('Unable to query Registration table: %s' % e)
+                else:
+                    if registration:
+                        reconcile_payment(registration,
+                                          r.json()['total_received'])
         else:
             results['successful'] = False
             logger(
@@ -396,6 +439,7 @@ def btctrans(request, btc_address):
 
 @login_required
 @user_passes_test(in_managers_group, login_url='/forbidden/')
+@traffic.traffic_view
 def address_report(request):
     logger.info('Presenting addresses available report')
     try:
@@ -415,11 +459,13 @@ def address_report(request):
 
 @login_required
 @user_passes_test(in_managers_group, login_url='/forbidden/')
+@traffic.traffic_view
 def registration_report(request):
     logger.info('Presenting registration report')
 
-    # Get queryset of registrations and create dictionary.
+    # Get queryset of registrations and create dictionaries.
     registration_dict = {}
+    registration_records = {}
     try:
         registrations = Registration.objects.order_by('date_added')
     except Exception as e:
@@ -439,11 +485,12 @@ def registration_report(request):
             registration_info.btc_address = registration.btc_address
 
             registration_dict[registration.btc_address] = registration_info
+            registration_records[registration.btc_address] = registration
 
         # Get transaction information for the BTC addresses.
         try:
-            r = requests.get('https://blockchain.info/multiaddr?active=%s' %
-                             '|'.join(registration_dict.keys()))
+            r = traffic.get('https://blockchain.info/multiaddr?active=%s' %
+                            '|'.join(sorted(registration_dict.keys())))
         except requests.exceptions.Timeout:
             logger.error('Timeout querying for multiple transaction info')
         except requests.exceptions.RequestException as e:
@@ -458,6 +505,11 @@ def registration_report(request):
                     if registration_info.received_mbtc >= registration_info.payment_mbtc:
                         registration_info.paid = True
 
+                    # Reconcile the stored payment and the event summary.
+                    reconcile_payment(
+                        registration_records[address_info['address']], amount
+                    )
+
         registration_infos = registration_dict.values()
         registration_infos.sort(key=lambda r: r.date_added, reverse=True)
     else:
@@ -470,6 +522,36 @@ def registration_report(request):
                    'environment_name': settings.ENVIRONMENT_NAME})
 
 
+@login_required
+@user_passes_test(in_managers_group, login_url='/forbidden/')
+def event_summary(request):
+    try:
+        summary = EventSummary.get_summary()
+    except Exception as e:
+        logger.error('Unable to query EventSummary table: %s' % e)
+        return render(request, '500.html',
+                      {'event_name': settings.EVENT_NAME,
+                       'environment_name': settings.ENVIRONMENT_NAME})
+
+    # Convert the BTC amounts from Satoshis to mBTC.
+    results = {}
+    results['timestamp'] = timezone.localtime(summary.date_updated).strftime('%m/%d/%Y %H:%M:%S %Z')
+    results['registration_count'] = summary.registration_count
+    results['payment_usd'] = '%.2f' % summary.payment_usd
+    results['payment_mbtc'] = '%.5f' % (Decimal(summary.payment_btc) / 100000)
+    results['received_mbtc'] = '%.5f' % (Decimal(summary.received_btc) / 100000)
+    results['paid_count'] = summary.paid_count
+    results['available_addresses'] = summary.available_addresses
+
+    if request.GET.get('format', None) == 'json':
+        json_data = json.dumps(results)
+        return HttpResponse(json_data, content_type='application/json')
+    return render(request, 'event_summary.html',
+                  {'summary': results,
+                   'event_name': settings.EVENT_NAME,
+                   'environment_name': settings.ENVIRONMENT_NAME})
+
+
 def not_available(request):
     return render(request, 'not_available.html',
                   {'event_name': settings.EVENT_NAME,